@@ -16,8 +16,9 @@ if __name__ == '__main__':
     parser.add_argument('-w', '--web-date', metavar='DATE', help='date when the website was last updated')
     args = parser.parse_args()
 
-    # Open a connection to the database.
-    database = sqlite3.connect(args.database, autocommit=False)
+    # Open a read-only connection to the database. Every query runs in the same transaction, so the export reflects a
+    # single committed state even while sync.py is updating the database.
+    database = sqlite3.connect(f'file:{args.database}?mode=ro', uri=True, autocommit=False)
 
     # Get the current date.
     current_date = datetime.now(timezone.utc).replace(microsecond=0)
@@ -32,7 +33,8 @@ if __name__ == '__main__':
     if web_date > current_date:
         raise RuntimeError('Web date is in the future')
 
-    # Convert both dates to ISO 8601 strings.
+    # Convert both dates to ISO 8601 strings, and the web date to seconds since the epoch for comparing with ratings.
+    web_epoch = int(web_date.timestamp())
     current_date = current_date.isoformat()
     web_date = web_date.isoformat()
 
@@ -48,8 +50,8 @@ if __name__ == '__main__':
         # Number of regions written.
         region_count = 0
 
-        # Iterate over all the region names.
-        for server_region, in database.execute('SELECT DISTINCT server_region from ratings'):
+        # Iterate over all the regions with ratings.
+        for region_id, server_region in database.execute('SELECT region_id, server_region FROM region_ids WHERE region_id IN (SELECT region_id FROM ratings_by_id) ORDER BY server_region'):
 
             # Write the trailing comma if necessary.
             if region_count > 0:
@@ -64,31 +66,31 @@ if __name__ == '__main__':
                 with
                     region_ratings as (
                         select
-                            player_name,
-                            rating_date,
+                            player_id,
+                            rating_epoch,
                             rating_mu,
                             rating_sigma,
-                            unixepoch(:web_date) - unixepoch(rating_date) as rating_secs_till_web_date
+                            :web_epoch - rating_epoch as rating_secs_till_web_date
                         from
-                            ratings
+                            ratings_by_id
                         where
-                            server_region = :server_region
+                            region_id = :region_id
                     ),
                     region_ratings_indexed_by_date as (
                         select
-                            player_name,
+                            player_id,
                             rating_mu,
                             rating_sigma,
-                            row_number() over (partition by player_name order by rating_date desc) as rating_index
+                            row_number() over (partition by player_id order by rating_epoch desc) as rating_index
                         from
                             region_ratings
                     ),
                     region_ratings_occurring_on_or_before_web_date_indexed_by_secs_till_web_date as (
                         select
-                            player_name,
+                            player_id,
                             rating_mu,
                             rating_sigma,
-                            row_number() over (partition by player_name order by rating_secs_till_web_date asc) as rating_index
+                            row_number() over (partition by player_id order by rating_secs_till_web_date asc) as rating_index
                         from
                             region_ratings
                         where
@@ -96,7 +98,7 @@ if __name__ == '__main__':
                     ),
                     region_ratings_current as (
                         select
-                            player_name,
+                            player_id,
                             rating_mu as current_rating_mu,
                             rating_sigma as current_rating_sigma
                         from
@@ -106,7 +108,7 @@ if __name__ == '__main__':
                     ),
                     region_ratings_prior as (
                         select
-                            player_name,
+                            player_id,
                             rating_mu as prior_rating_mu,
                             rating_sigma as prior_rating_sigma
                         from
@@ -116,13 +118,13 @@ if __name__ == '__main__':
                     ),
                     region_totals as (
                         select
-                            player_name,
+                            player_id,
                             count() as total_matches_played,
-                            date(max(rating_date)) as last_played_date
+                            date(max(rating_epoch), 'unixepoch') as last_played_date
                         from
                             region_ratings
                         group by
-                            player_name
+                            player_id
                     )
                 select
                     player_name,
@@ -132,10 +134,13 @@ if __name__ == '__main__':
                     last_played_date
                 from
                     region_ratings_current
-                        left join region_ratings_prior using (player_name)
-                        left join region_totals using (player_name)
+                        natural join player_ids
+                        left join region_ratings_prior using (player_id)
+                        left join region_totals using (player_id)
+                order by
+                    player_name
                 ''',
-                {'server_region': server_region, 'web_date': web_date}
+                {'region_id': region_id, 'web_epoch': web_epoch}
             )
 
             # Number of ratings written.
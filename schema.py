@@ -0,0 +1,328 @@
+# For reading query plans.
+import re
+
+# Timestamps.
+from datetime import datetime, timezone
+
+# Common table expressions summarizing the teams of each match, optionally restricted to a subset of the "players" table.
+# NOTE: Only use well-formed matches: deathmatch mode 1, teamplay mode 2,
+# 20 minute time limit, 8 total players, two teams of 4, full duration.
+# Match duration as reported by the hub is bugged so we use total quads
+# taken to decide when a match was completed.
+def well_formed_tables(players='players'):
+    return f'''
+    teams as (
+        select
+            match_id,
+            player_team,
+            count(*) as team_size,
+            sum(player_quad_taken) as team_quad_taken
+        from
+            {players}
+        group by
+            match_id,
+            player_team
+    ),
+    totals as (
+        select
+            match_id,
+            count(*) as total_teams,
+            sum(team_size) as total_players,
+            sum(team_quad_taken) as total_quad_taken
+        from
+            teams
+        group by
+            match_id
+    )
+    '''
+
+# Conditions on the common table expressions above, plus the "matches" table, selecting well-formed matches.
+WELL_FORMED_CONDITIONS = '''
+    match_deathmatch_mode = 1
+        and
+    match_teamplay_mode = 2
+        and
+    match_time_limit_mins = 20
+        and
+    team_size = 4
+        and
+    total_teams = 2
+        and
+    total_players = 8
+        and
+    total_quad_taken = 20
+'''
+
+# Migration 1: the tables as they were before the schema was versioned. Databases created earlier may already have
+# some of them.
+def baseline(player_columns, stat_keys):
+    return f'''
+    CREATE TABLE IF NOT EXISTS checkpoints(
+        checkpoint_name TEXT,
+        checkpoint_date TEXT,
+        checkpoint_match_id INTEGER,
+        PRIMARY KEY(checkpoint_name)
+    );
+    CREATE TABLE IF NOT EXISTS geoip(
+        geoip_address TEXT,
+        geoip_country TEXT,
+        geoip_date TEXT,
+        PRIMARY KEY(geoip_address)
+    );
+    CREATE TABLE IF NOT EXISTS servers(
+        server_name TEXT,
+        server_region TEXT,
+        PRIMARY KEY(server_name)
+    );
+    CREATE TABLE IF NOT EXISTS addresses(
+        address_ip TEXT,
+        address_port INTEGER,
+        server_name TEXT,
+        address_last_seen TEXT,
+        address_last_probe_date TEXT,
+        address_last_probe_result TEXT,
+        address_probe_latency_secs REAL,
+        address_probe_failures INTEGER,
+        PRIMARY KEY(address_ip, address_port)
+    );
+    CREATE TABLE IF NOT EXISTS matches(
+        match_id INTEGER,
+        match_date TEXT,
+        match_tag TEXT,
+        match_map TEXT,
+        server_name TEXT,
+        server_port INTEGER,
+        match_deathmatch_mode INTEGER,
+        match_teamplay_mode INTEGER,
+        match_time_limit_mins INTEGER,
+        match_duration_secs INTEGER,
+        match_demo_sha256 TEXT,
+        PRIMARY KEY(match_id)
+    );
+    CREATE TABLE IF NOT EXISTS players(
+        match_id INTEGER,
+        {''.join(f'{column.name} {column.type},' for column in player_columns)}
+        PRIMARY KEY(match_id, player_name)
+    );
+    CREATE TABLE IF NOT EXISTS pending_matches(
+        match_id INTEGER,
+        match_date TEXT,
+        match_demo_sha256 TEXT,
+        pending_attempts INTEGER,
+        pending_next_retry TEXT,
+        pending_error TEXT,
+        PRIMARY KEY(match_id)
+    );
+    CREATE TABLE IF NOT EXISTS well_formed_matches(
+        match_id INTEGER,
+        match_date TEXT,
+        server_region TEXT,
+        PRIMARY KEY(match_id)
+    );
+    CREATE INDEX IF NOT EXISTS well_formed_matches_by_region_and_date ON well_formed_matches(server_region, match_date);
+    CREATE INDEX IF NOT EXISTS matches_by_server_name ON matches(server_name);
+    INSERT OR IGNORE INTO well_formed_matches
+    WITH
+        {well_formed_tables()}
+    SELECT
+        match_id,
+        match_date,
+        server_region
+    FROM
+        matches
+            NATURAL JOIN
+        teams
+            NATURAL JOIN
+        totals
+            NATURAL LEFT JOIN
+        servers
+    WHERE
+        {WELL_FORMED_CONDITIONS}
+    GROUP BY
+        match_id;
+    CREATE TABLE IF NOT EXISTS means(
+        server_region TEXT,
+        {','.join(f'mean_{key} REAL' for key in stat_keys)},
+        PRIMARY KEY(server_region)
+    );
+    CREATE TABLE IF NOT EXISTS standard_deviations(
+        server_region TEXT,
+        {','.join(f'standard_deviation_{key} REAL' for key in stat_keys)},
+        PRIMARY KEY(server_region)
+    );
+    CREATE TABLE IF NOT EXISTS moments(
+        server_region TEXT,
+        {','.join(f'moment_count_{key} INTEGER, moment_mean_{key} REAL, moment_m2_{key} REAL' for key in stat_keys)},
+        PRIMARY KEY(server_region)
+    );
+    CREATE TABLE IF NOT EXISTS moment_matches(
+        match_id INTEGER,
+        PRIMARY KEY(match_id)
+    );
+    CREATE TABLE IF NOT EXISTS ratings(
+        server_region TEXT,
+        player_name TEXT,
+        rating_date TEXT,
+        rating_mu REAL,
+        rating_sigma REAL,
+        PRIMARY KEY(server_region, player_name, rating_date)
+    );
+    '''
+
+# Migration 2: indexes for finding the latest match, walking well-formed matches in date order and draining the retry
+# queue, plus statistics for the query planner.
+def indexes(player_columns, stat_keys):
+    return '''
+    CREATE INDEX matches_by_date ON matches(match_date);
+    CREATE INDEX well_formed_matches_by_date ON well_formed_matches(match_date, match_id);
+    CREATE INDEX pending_matches_by_next_retry ON pending_matches(pending_next_retry);
+    ANALYZE;
+    '''
+
+# Migration 3: match scores kept between runs, with the versions of the normals and weights they were computed with,
+# and a table of the current versions of things.
+def scores(player_columns, stat_keys):
+    return '''
+    CREATE TABLE match_scores(
+        match_id INTEGER,
+        player_name TEXT,
+        score REAL,
+        normals_version INTEGER,
+        weights_version TEXT,
+        PRIMARY KEY(match_id, player_name)
+    );
+    CREATE TABLE versions(
+        version_name TEXT,
+        version_value TEXT,
+        PRIMARY KEY(version_name)
+    );
+    '''
+
+# Migration 4: snapshots of the ratings in effect in each region after a match, to replay late matches from, and the
+# matches that have been rated. Matches up to the ratings checkpoint are taken to have been rated already or, in
+# databases rated before checkpoints were kept, those whose ratings (dated 20 minutes after the start of the match)
+# would be dated no later than the latest rating.
+def snapshots(player_columns, stat_keys):
+    return '''
+    CREATE TABLE rating_snapshots(
+        server_region TEXT,
+        snapshot_date TEXT,
+        snapshot_match_id INTEGER,
+        snapshot_ratings TEXT,
+        PRIMARY KEY(server_region, snapshot_date, snapshot_match_id)
+    );
+    CREATE TABLE rating_matches(
+        match_id INTEGER,
+        PRIMARY KEY(match_id)
+    );
+    INSERT INTO rating_matches
+    SELECT
+        match_id
+    FROM
+        well_formed_matches
+    WHERE
+        server_region IS NOT NULL
+            AND
+        iif(
+            EXISTS (SELECT * FROM checkpoints WHERE checkpoint_name = 'ratings'),
+            (match_date, match_id) <= (SELECT checkpoint_date, checkpoint_match_id FROM checkpoints WHERE checkpoint_name = 'ratings'),
+            unixepoch(match_date) + 1200 <= (SELECT max(unixepoch(rating_date)) FROM ratings)
+        );
+    '''
+
+# Migration 5: ratings keyed by the IDs of their region and player and dated in seconds since the epoch, with a view
+# that keeps the old columns for existing queries.
+def compact_ratings(player_columns, stat_keys):
+    return '''
+    CREATE TABLE region_ids(
+        region_id INTEGER,
+        server_region TEXT UNIQUE,
+        PRIMARY KEY(region_id)
+    );
+    CREATE TABLE player_ids(
+        player_id INTEGER,
+        player_name TEXT UNIQUE,
+        PRIMARY KEY(player_id)
+    );
+    INSERT INTO region_ids(server_region) SELECT DISTINCT server_region FROM ratings ORDER BY server_region;
+    INSERT INTO player_ids(player_name) SELECT DISTINCT player_name FROM ratings ORDER BY player_name;
+    CREATE TABLE ratings_by_id(
+        region_id INTEGER,
+        player_id INTEGER,
+        rating_epoch INTEGER,
+        rating_mu REAL,
+        rating_sigma REAL,
+        PRIMARY KEY(region_id, player_id, rating_epoch)
+    ) WITHOUT ROWID;
+    INSERT OR REPLACE INTO ratings_by_id
+    SELECT
+        region_id,
+        player_id,
+        unixepoch(rating_date),
+        rating_mu,
+        rating_sigma
+    FROM
+        ratings
+            NATURAL JOIN
+        region_ids
+            NATURAL JOIN
+        player_ids
+    ORDER BY
+        region_id,
+        player_id,
+        rating_date;
+    DROP TABLE ratings;
+    CREATE VIEW ratings AS
+    SELECT
+        server_region,
+        player_name,
+        strftime('%Y-%m-%dT%H:%M:%S+00:00', rating_epoch, 'unixepoch') AS rating_date,
+        rating_mu,
+        rating_sigma
+    FROM
+        ratings_by_id
+            NATURAL JOIN
+        region_ids
+            NATURAL JOIN
+        player_ids;
+    '''
+
+# Numbered migrations, in order. Each takes the columns of the "players" table and the keys of the stats and returns
+# a script. Never change a migration once released; append a new one instead.
+MIGRATIONS = [
+    baseline,
+    indexes,
+    scores,
+    snapshots,
+    compact_ratings,
+]
+
+# Bring the schema of a database up to date.
+def migrate(database, player_columns, stat_keys):
+    # Create the table of applied migrations if necessary.
+    database.executescript('CREATE TABLE IF NOT EXISTS schema_version(schema_version INTEGER, schema_date TEXT, PRIMARY KEY(schema_version));')
+    version = database.execute('SELECT coalesce(max(schema_version), 0) FROM schema_version').fetchone()[0]
+
+    # Apply the pending migrations. The connection is always in a transaction, so each one is committed as a whole.
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        print(f'Migrating schema to version {number}...')
+        database.executescript(migration(player_columns, stat_keys))
+        database.execute('INSERT INTO schema_version(schema_version, schema_date) VALUES(?,?)', (number, datetime.now(timezone.utc).isoformat()))
+        database.commit()
+
+    # Add any "players" columns that were introduced since the table was created.
+    existing_columns = set(row[1] for row in database.execute('PRAGMA table_info(players)'))
+    for column in player_columns:
+        if column.name not in existing_columns:
+            database.execute(f'ALTER TABLE players ADD COLUMN {column.name} {column.type}')
+    database.commit()
+
+# Get the steps of the query plan of a statement.
+def query_plan(database, sql, parameters=()):
+    return [row[3] for row in database.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)]
+
+# Check that a statement reads the given tables through indexes, and takes its order from one if it is ordered,
+# returning the offending steps of its plan.
+def unindexed_steps(database, sql, parameters=(), tables=(), ordered=False):
+    pattern = re.compile(rf'^SCAN ({'|'.join(tables)})\b' + ('|TEMP B-TREE FOR ORDER BY' if ordered else ''))
+    return [step for step in query_plan(database, sql, parameters) if pattern.search(step)]
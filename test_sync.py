@@ -0,0 +1,271 @@
+import collections, contextlib, io, math, os, random, socket, sqlite3, tempfile, threading, unittest, unittest.mock
+
+import requests
+
+import sync
+
+# Open a database with the current schema in a temporary directory.
+def temporary_database(test):
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    database = sqlite3.connect(os.path.join(directory.name, 'test.db'), autocommit=False)
+    test.addCleanup(database.close)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sync.schema.migrate(database, sync.PLAYER_COLUMNS, sync.STATS.keys())
+    return database
+
+# A canned response to an HTTP request.
+class FakeResponse:
+    def __init__(self, status_code, lines=(), data=None):
+        self.status_code = status_code
+        self.lines = lines
+        self.data = data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} Error', response=self)
+
+    def iter_lines(self, decode_unicode=False):
+        return iter(self.lines)
+
+    def json(self):
+        return self.data
+
+# Tests for the hostname sweep.
+class HostnamesTest(unittest.TestCase):
+    # Open a UDP socket on localhost that never replies.
+    def silent_server(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        self.addCleanup(sock.close)
+        return sock.getsockname()
+
+    # Open a UDP socket on localhost that replies to every status request with the given hostname.
+    def live_server(self, name):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(0.1)
+        stop = threading.Event()
+        def serve():
+            while not stop.is_set():
+                try:
+                    _, origin = sock.recvfrom(65507)
+                except TimeoutError:
+                    continue
+                sock.sendto(b'\xff\xff\xff\xffn\\hostname\\' + name.encode() + b'\\maxclients\\16\n', origin)
+        thread = threading.Thread(target=serve)
+        thread.start()
+        self.addCleanup(sock.close)
+        self.addCleanup(thread.join)
+        self.addCleanup(stop.set)
+        return sock.getsockname()
+
+    # A live server queued behind more unresponsive servers than the in-flight limit is still asked.
+    def test_dead_servers_beyond_limit(self):
+        dead = [self.silent_server() for _ in range(10)]
+        live = self.live_server('live')
+        results = {address: result for address, result, _ in sync.hostnames(dead + [live], timeout=0.3, limit=4)}
+        self.assertEqual(results[live], 'live')
+        for address in dead:
+            self.assertIsInstance(results[address], TimeoutError)
+
+    # A server whose address can't be placed in a region yet is probed again on the next run.
+    def test_unplaced_server_is_probed_again(self):
+        database = temporary_database(self)
+        ip, port = self.live_server('myserver')
+        ipinfo = FakeResponse(429)
+        def get(url, **kwargs):
+            if 'ipinfo.io' in url:
+                return ipinfo
+            return FakeResponse(200, [f'{ip}:{port}'])
+        with unittest.mock.patch.object(sync.requests, 'get', get), contextlib.redirect_stdout(io.StringIO()):
+            sync.servers(database, timeout=0.3)
+            self.assertEqual(database.execute('SELECT * FROM servers').fetchall(), [])
+            ipinfo = FakeResponse(200, data={'country': 'SE'})
+            sync.servers(database, timeout=0.3)
+        self.assertEqual(database.execute('SELECT * FROM servers').fetchall(), [('myserver', 'Europe')])
+        self.assertEqual(database.execute('SELECT server_name, address_probe_failures FROM addresses').fetchall(), [('myserver', 0)])
+
+# Tests for the batch scores, against the scores of individual players.
+class ScoresTest(unittest.TestCase):
+    # Fill in the normals of two regions. Some stats have no spread, so their standard scores are zero.
+    def setUp(self):
+        sync.NORMALS.clear()
+        self.addCleanup(sync.NORMALS.clear)
+        self.database = sqlite3.connect(':memory:')
+        self.addCleanup(self.database.close)
+        self.database.execute(f'CREATE TABLE means(server_region TEXT, {','.join(f'mean_{key} REAL' for key in sync.STATS)})')
+        self.database.execute(f'CREATE TABLE standard_deviations(server_region TEXT, {','.join(f'standard_deviation_{key} REAL' for key in sync.STATS)})')
+        for server_region, offset in (('Europe', 0), ('Oceania', 7)):
+            self.database.execute(f'INSERT INTO means VALUES(?{',?' * len(sync.STATS)})', (server_region, *(0.25 * i + offset for i in range(len(sync.STATS)))))
+            self.database.execute(
+                f'INSERT INTO standard_deviations VALUES(?{',?' * len(sync.STATS)})',
+                (server_region, *(0 if key in ('frags', 'rl_accuracy', 'ping') else 1.5 + 0.125 * i + offset for i, key in enumerate(sync.STATS)))
+            )
+
+    # Make a player whose stats are all set from a base value, with some fields overridden.
+    def player(self, name, base, **fields):
+        values = {field: base + i for i, field in enumerate(sorted(sync.Player._fields)) if field != 'name'}
+        values.update(fields)
+        return sync.Player(name=name, **values)
+
+    # Players with ordinary stats, no attempts with any weapon, no frags or deaths, and nothing at all.
+    def players(self):
+        no_attempts = {field: 0 for field in sync.Player._fields if field.endswith('_attacks')}
+        return [
+            self.player('ordinary', 3),
+            self.player('more hits than attempts', 2, rl_virtual=50, rl_attacks=10, lg_hits=7, lg_attacks=7),
+            self.player('no attempts', 5, **no_attempts),
+            self.player('no frags or deaths', 4, frags=0, deaths=0),
+            self.player('nothing', 0),
+        ]
+
+    # The batch scores are identical to the scores of individual players, in every region.
+    def test_batch_scores_match_player_scores(self):
+        players = self.players() * 2
+        server_regions = ['Europe'] * 5 + ['Oceania'] * 5
+        batch = sync.batch_scores(self.database, server_regions, players).tolist()
+        expected = [sync.scorer(self.database, server_region)(player) for server_region, player in zip(server_regions, players)]
+        self.assertEqual(batch, expected)
+        self.assertTrue(all(math.isfinite(score) for score in batch))
+
+    # Stats without spread and ratio stats that aren't defined have standard scores of zero.
+    def test_undefined_standard_scores(self):
+        zscores = sync.batch_zscores(self.database, ['Europe'] * 5, self.players())
+        for key in ('frags', 'rl_accuracy', 'ping'):
+            self.assertEqual(zscores[:, sync.ZSCORE_COLUMNS[key]].tolist(), [0] * 5)
+        for key in sync.ACCURACIES:
+            self.assertEqual(zscores[2, sync.ZSCORE_COLUMNS[key]], 0)
+        self.assertEqual(zscores[3, sync.ZSCORE_COLUMNS['efficiency']], 0)
+        self.assertNotEqual(zscores[0, sync.ZSCORE_COLUMNS['efficiency']], 0)
+
+    # A player with no attempts scores as if the accuracy terms were left out of the weights.
+    def test_missing_ratio_stats_are_skipped(self):
+        player = self.players()[2]
+        weights = sync.WEIGHTS._replace(terms=tuple((key, weight) for key, weight in sync.WEIGHTS.terms if key not in sync.ACCURACIES))
+        self.assertEqual(sync.batch_scores(self.database, ['Europe'], [player]).tolist(), [sync.scorer(self.database, 'Europe', weights)(player)])
+
+# Tests for the TrueSkill update of ranked matches, against the trueskill package.
+class RankedRaterTest(unittest.TestCase):
+    # Rate a match with both ranked_rater() and the trueskill package, checking that they agree, or that both fail.
+    def assertRatesLikeTrueSkill(self, priors):
+        environment = sync.ENVIRONMENT
+        try:
+            expected = [(group[0].mu, group[0].sigma) for group in environment.rate([(environment.create_rating(*prior),) for prior in priors])]
+        except FloatingPointError:
+            with self.assertRaises(FloatingPointError):
+                sync.ranked_rater(environment)(priors)
+            return
+        self.assertEqual(sync.ranked_rater(environment)(priors), expected)
+
+    # Matches between new players.
+    def test_new_players(self):
+        default = sync.ENVIRONMENT.mu, sync.ENVIRONMENT.sigma
+        for size in (2, 3, 8):
+            with self.subTest(size=size):
+                self.assertRatesLikeTrueSkill([default] * size)
+
+    # Matches between established players, including upsets and a player who is already rated precisely.
+    def test_established_players(self):
+        for priors in (
+            [(1800, 120), (1200, 150)],
+            [(1200, 150), (1800, 120)],
+            [(1500, 80)] * 8,
+            [(1500, 500), (1450, 1), (1700, 200), (900, 300)],
+            [(2900, 30), (100, 30), (2800, 40), (150, 40), (2700, 50), (200, 50), (2600, 60), (250, 60)],
+        ):
+            with self.subTest(priors=priors):
+                self.assertRatesLikeTrueSkill(priors)
+
+    # A match too lopsided for the update to be calculated fails the same way in both.
+    def test_unlikely_upset(self):
+        self.assertRatesLikeTrueSkill([(0, 1), (30000, 1)])
+
+    # Random matches of the usual sizes, some of them with new players.
+    def test_random_matches(self):
+        generator = random.Random(0)
+        for _ in range(200):
+            priors = []
+            for _ in range(generator.choice([2, 3, 4, 8, 8, 8])):
+                if generator.random() < 0.2:
+                    priors.append((sync.ENVIRONMENT.mu, sync.ENVIRONMENT.sigma))
+                else:
+                    priors.append((generator.uniform(0, 3000), generator.uniform(20, 500)))
+            with self.subTest(priors=priors):
+                self.assertRatesLikeTrueSkill(priors)
+
+# Tests for loading sets of weights.
+class WeightsTest(unittest.TestCase):
+    # Write a set of weights to a temporary file and load it.
+    def load(self, lines):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'weights.txt')
+        with open(path, 'w') as stream:
+            stream.write('\n'.join(lines) + '\n')
+        return sync.load_weights(path)
+
+    # The version changes with any weight, even when the survey date stays the same.
+    def test_version_follows_weights(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(sync.__file__)), 'weights.txt')) as stream:
+            lines = [line.strip() for line in stream if line.strip() != '']
+        self.assertEqual(self.load(lines).version, sync.WEIGHTS.version)
+        edited = lines[:2] + [str(-float(lines[2]))] + lines[3:]
+        self.assertNotEqual(self.load(edited).version, sync.WEIGHTS.version)
+        self.assertTrue(self.load(edited).version.startswith(f'{lines[0]}:'))
+
+# Tests for rating matches.
+class RatingsTest(unittest.TestCase):
+    # Make the KTX stats of a match between two teams of four, with the quads adding up to 20 when well-formed.
+    def ktx(self, generator, server_name, time_limit):
+        players = []
+        for i, name in enumerate(generator.sample([f'player{j}' for j in range(16)], 8)):
+            players.append({
+                'name': name,
+                'login': '',
+                'team': 'red' if i < 4 else 'blue',
+                'top-color': 4,
+                'bottom-color': 4,
+                'ping': generator.randint(10, 90),
+                'stats': {'frags': generator.randint(0, 80), 'deaths': generator.randint(0, 80), 'tk': generator.randint(0, 4), 'spawn-frags': generator.randint(0, 8), 'suicides': 0},
+                'dmg': {'taken': generator.randint(0, 9000), 'given': generator.randint(0, 9000), 'team': 0, 'self': 0, 'team-weapons': 0, 'enemy-weapons': generator.randint(0, 5000), 'taken-to-die': 100},
+                'spree': {'max': generator.randint(0, 10), 'quad': 0},
+                'speed': {'max': 800.0, 'avg': 300.0},
+                'weapons': {'rl': {'acc': {'attacks': generator.randint(0, 300), 'hits': generator.randint(0, 100), 'virtual': generator.randint(0, 120)}}},
+                'items': {'q': {'took': 3 - i % 2}},
+            })
+        return {'map': 'dm2', 'hostname': server_name, 'port': 27500, 'dm': 1, 'tp': 2, 'tl': time_limit, 'duration': 1200, 'players': players}
+
+    # Build a database of matches on servers in two regions, a few of them not well-formed, with their normals.
+    def setUp(self):
+        sync.NORMALS.clear()
+        self.addCleanup(sync.NORMALS.clear)
+        self.database = temporary_database(self)
+        self.database.executemany('INSERT INTO servers(server_name, server_region) VALUES(?,?)', [('eu server', 'Europe'), ('na server', 'North America')])
+        generator = random.Random(0)
+        batch = []
+        for i in range(24):
+            match = {'id': 100 + i, 'timestamp': f'2024-01-01T{i:02d}:00:00+00:00', 'demo_sha256': f'{i:064x}'}
+            batch.append(sync.records(match, self.ktx(generator, ('eu server', 'na server')[i % 2], 10 if i % 5 == 0 else 20)))
+        sync.ingest(self.database.cursor(), batch)
+        with contextlib.redirect_stdout(io.StringIO()):
+            sync.normals(self.database)
+        self.database.commit()
+
+    # Every well-formed match is rated exactly once, whether regions are rated in one process or several.
+    def test_rater_calls(self):
+        match_count = self.database.execute('SELECT count(DISTINCT match_id) FROM well_formed_matches WHERE server_region IS NOT NULL').fetchone()[0]
+        self.assertEqual(match_count, 19)
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                self.database.execute('DELETE FROM ratings_by_id')
+                self.database.execute('DELETE FROM rating_matches')
+                self.database.commit()
+                calls = collections.Counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    sync.ratings(self.database, '1970-01-01', None, None, jobs, 5000, calls)
+                self.assertEqual(calls['rate'], match_count)
+                self.assertEqual(self.database.execute('SELECT count(*) FROM rating_matches').fetchone()[0], match_count)
+
+if __name__ == '__main__':
+    unittest.main()